@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """Performance test to compare the performance of buck between two revisions.
 
 The general algorithm is:
@@ -18,16 +18,31 @@ For each revision to test:
 
 """
 import argparse
+import hashlib
+import json
+import mmap
 import re
 import subprocess
 import os
+import shutil
 import tempfile
 import sys
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from datetime import datetime
 
 
+# chg keeps a persistent hg server around, saving the hg startup cost on
+# every command.
+HG_BINARY = shutil.which('chg') or 'hg'
+
+
+# Where the revisions to test are remembered between runs.
+REVISIONS_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'buck-perf')
+
+
 def createArgParser():
     parser = argparse.ArgumentParser(
         description='Run the buck performance test')
@@ -80,14 +95,16 @@ def createArgParser():
 
 
 def log(message):
-    print '%s\t%s' % (str(datetime.now()), message)
-    sys.stdout.flush()
+    print('%s\t%s' % (datetime.now().isoformat(), message))
 
 
-def timedelta_total_seconds(timedelta):
-    return (
-        timedelta.microseconds + 0.0 +
-        (timedelta.seconds + timedelta.days * 24 * 3600) * 10 ** 6) / 10 ** 6
+# The rules which got a given cache result, stored as parallel lists.
+CacheResults = namedtuple(
+    'CacheResults', ['rule_names', 'rule_keys', 'rule_key_debugs'])
+
+
+def new_cache_results():
+    return CacheResults([], [], [])
 
 
 class BuildResult():
@@ -97,17 +114,45 @@ class BuildResult():
         self.rule_key_map = rule_key_map
 
 
+def hg(hg_args, cwd):
+    subprocess.check_call([HG_BINARY] + hg_args, cwd=cwd)
+
+
+def hg_output(hg_args, cwd):
+    return subprocess.check_output(
+        [HG_BINARY] + hg_args,
+        cwd=cwd,
+        universal_newlines=True)
+
+
 def clean(cwd):
     log('Running hg purge.')
-    subprocess.check_call(
-        ['hg', 'purge', '--all'],
-        cwd=cwd)
+    hg(['purge', '--all'], cwd)
 
 
 def reset(revision, cwd):
-    subprocess.check_call(
-        ['hg', 'revert', '-a', '-r', revision],
-        cwd=cwd)
+    hg(['revert', '-a', '-r', revision], cwd)
+
+
+def write_file_if_changed(path, contents):
+    """Atomically replaces the contents of path, unless they already match.
+    """
+    try:
+        with open(path, 'r') as existing_file:
+            if existing_file.read() == contents:
+                return
+    except IOError:
+        pass
+    # Opened normally, so the file keeps the permissions the umask gives it.
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as tmp_file:
+            tmp_file.write(contents)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
 
 
 def buck_clean(args, cwd):
@@ -117,49 +162,125 @@ def buck_clean(args, cwd):
         cwd=cwd)
 
 
+def buck_kill(args, cwd):
+    log('Running buck kill.')
+    # Best effort, the rename goes ahead even if buckd could not be stopped.
+    returncode = subprocess.call(
+        [args.path_to_buck, 'kill'],
+        cwd=cwd)
+    if returncode:
+        log('buck kill failed with exit code %d.' % returncode)
+
+
 def get_revisions(args):
-    cmd = ['hg', 'log',
-            '--limit', str(args.revisions_to_go_back + 1),
-            '-T', '{node}\\n',
-            # only look for changes under specific folder
-            args.project_under_test
-            ]
-    proc = subprocess.Popen(
-        cmd,
-        cwd=args.repo_under_test,
-        stdout=subprocess.PIPE)
+    """Returns the revisions to test, oldest first.
+
+    Walking the history of the project under test can take a while on large
+    repos, so the result is cached on disk for as long as the repo's heads
+    are unchanged and the cached revisions can still be checked out.
+    """
+    heads = hg_output(
+        ['log', '-r', 'heads(all())', '-T', '{rev}:{node}\\n'],
+        args.repo_under_test)
+    cache_key = hashlib.sha1(json.dumps(
+        [heads, args.project_under_test, args.revisions_to_go_back]
+    ).encode('utf-8')).hexdigest()
+    cache_path = os.path.join(
+        REVISIONS_CACHE_DIR,
+        'revisions-%s.json' % cache_key)
     try:
-        return list(reversed(proc.communicate()[0].splitlines()))
-    finally:
-        if proc.wait():
-            raise subprocess.CalledProcessError(
-                proc.returncode,
-                ' '.join(cmd))
+        with open(cache_path, 'r') as cache_file:
+            revisions = json.load(cache_file)
+        # Stripped or obsoleted revisions below the heads no longer resolve.
+        # Called directly, as a failure here is expected and kept quiet.
+        if revisions and subprocess.call(
+                [HG_BINARY, 'log', '-r', '+'.join(revisions), '-T', ''],
+                cwd=args.repo_under_test,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL) == 0:
+            return revisions
+    except (IOError, ValueError):
+        pass
+
+    output = hg_output(
+        ['log',
+         '--limit', str(args.revisions_to_go_back + 1),
+         '-T', '{node}\\n',
+         # only look for changes under specific folder
+         args.project_under_test
+         ],
+        args.repo_under_test)
+    revisions = output.splitlines()[::-1]
+    os.makedirs(REVISIONS_CACHE_DIR, exist_ok=True)
+    write_file_if_changed(cache_path, json.dumps(revisions))
+    return revisions
 
 
 def checkout(revision, cwd):
     log('Checking out %s.' % revision)
-    subprocess.check_call(
-        ['hg', 'update', '--clean', revision],
-        cwd=cwd)
+    hg(['update', '--clean', revision], cwd)
+
+
+# How much of the end of buck's output to log when a build fails.
+BUILD_OUTPUT_TAIL_BYTES = 64 * 1024
 
 
+# Logs are parsed as bytes. The patterns are matched against the whole
+# memory-mapped file, so any that anchor on line ends are multiline.
 BUILD_RESULT_LOG_LINE = re.compile(
-    r'BuildRuleFinished\((?P<rule_name>[\w_\-:#\/,]+)\): (?P<result>[A-Z_]+) '
-    r'(?P<cache_result>[A-Z_]+) (?P<success_type>[A-Z_]+) '
-    r'(?P<rule_key>[0-9a-f]*)')
+    br'BuildRuleFinished\((?P<rule_name>[A-Za-z0-9_:#/,\-]+)\): '
+    br'(?P<result>[A-Z_]+) '
+    br'(?P<cache_result>[A-Z_]+) (?P<success_type>[A-Z_]+) '
+    br'(?P<rule_key>[0-9a-f]*)')
 
 
 RULEKEY_LINE = re.compile(
-    r'^INFO: RuleKey (?P<rule_key>[0-9a-f]*)='
-    r'(?P<rule_key_debug>.*)$')
+    br'(?m)^INFO: RuleKey (?P<rule_key>[0-9a-f]*)='
+    br'(?P<rule_key_debug>.*)$')
 
 
 BUCK_LOG_RULEKEY_LINE = re.compile(
-    r'.*\[[\w ]+\](?:\[command:[0-9a-f-]+\])?\[tid:\d+\]'
-    r'\[com.facebook.buck.rules.RuleKey[\$\.]?Builder\] '
-    r'RuleKey (?P<rule_key>[0-9a-f]+)='
-    r'(?P<rule_key_debug>.*)$')
+    br'(?m)\[[\w ]+\](?:\[command:[0-9a-f-]+\])?\[tid:\d+\]'
+    br'\[com.facebook.buck.rules.RuleKey[\$\.]?Builder\] '
+    br'RuleKey (?P<rule_key>[0-9a-f]+)='
+    br'(?P<rule_key_debug>.*)$')
+
+
+def find_all_in_file(pattern, log_file):
+    """Yields the groups of each match of pattern in log_file.
+
+    The file is memory-mapped so the pattern scans it in place instead of
+    copying it out line by line.
+    """
+    if os.fstat(log_file.fileno()).st_size == 0:
+        # Empty files cannot be mapped.
+        return
+    contents = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for match in pattern.finditer(contents):
+            yield tuple(
+                group.decode('utf-8', 'replace') for group in match.groups())
+    finally:
+        contents.close()
+
+
+# Maps (cwd, perftest_side) to the buck-0.log path rule keys are read from,
+# or None if that buck only logs them to its output.
+_java_utils_log_path_cache = {}
+
+
+def get_java_utils_log_path(cwd, perftest_side):
+    cache_key = (cwd, perftest_side)
+    if cache_key not in _java_utils_log_path_cache:
+        java_utils_log_path = os.path.join(
+            cwd,
+            'buck-out', 'log', 'buck-0.log')
+        try:
+            os.stat(java_utils_log_path)
+        except OSError:
+            java_utils_log_path = None
+        _java_utils_log_path_cache[cache_key] = java_utils_log_path
+    return _java_utils_log_path_cache[cache_key]
 
 
 def buck_build_target(args, cwd, targets, perftest_side, log_as_perftest=True):
@@ -168,92 +289,111 @@ def buck_build_target(args, cwd, targets, perftest_side, log_as_perftest=True):
     log('Running buck build %s.' % ' '.join(targets))
     bucklogging_properties_path = os.path.join(
         cwd, '.bucklogging.local.properties')
-    with open(bucklogging_properties_path, 'w') as bucklogging_properties:
-        # The default configuration has the root logger and FileHandler
-        # discard anything below FINE level.
-        #
-        # We need RuleKey logging, which uses FINER (verbose), so the
-        # root logger and file handler both need to be reconfigured
-        # to enable verbose logging.
-        bucklogging_properties.write(
-            '''.level=FINER
+    # The default configuration has the root logger and FileHandler
+    # discard anything below FINE level.
+    #
+    # We need RuleKey logging, which uses FINER (verbose), so the
+    # root logger and file handler both need to be reconfigured
+    # to enable verbose logging.
+    write_file_if_changed(
+        bucklogging_properties_path,
+        '''.level=FINER
             java.util.logging.FileHandler.level=FINER''')
-    env = os.environ.copy()
-    # Force buck to pretend it's repo is clean.
-    env.update({
-        'BUCK_REPOSITORY_DIRTY': '0'
-    })
     if log_as_perftest:
-        env.update({
+        perftest_env = {
             'BUCK_EXTRA_JAVA_ARGS':
             '-Dbuck.perftest_id=%s, -Dbuck.perftest_side=%s' % (
             args.perftest_id, perftest_side)
-        })
-    start = datetime.now()
-    tmpFile = tempfile.TemporaryFile()
-    try:
-        subprocess.check_call(
-            [args.path_to_buck, 'build', '--deep'] + targets + ['-v', '5'],
-            stdout=tmpFile,
-            stderr=tmpFile,
+        }
+    else:
+        perftest_env = {}
+    env = {
+        **os.environ,
+        # Force buck to pretend it's repo is clean.
+        'BUCK_REPOSITORY_DIRTY': '0',
+        **perftest_env
+    }
+    command = [args.path_to_buck, 'build', '--deep'] + targets + ['-v', '5']
+    # Buck writes straight to a file so nothing in this script slows the
+    # timed build down; the output is only read back once it has finished.
+    with tempfile.TemporaryFile() as output_file:
+        start = datetime.now()
+        returncode = subprocess.call(
+            command,
+            stdout=output_file,
+            stderr=output_file,
             cwd=cwd,
             env=env)
-    except:
-        tmpFile.seek(0)
-        log('Buck build failed: %s' % tmpFile.read())
-        raise
-    tmpFile.seek(0)
-    finish = datetime.now()
-
-    java_utils_log_path = os.path.join(
-        cwd,
-        'buck-out', 'log', 'buck-0.log')
-    if os.path.exists(java_utils_log_path):
-        pattern = BUCK_LOG_RULEKEY_LINE
-        build_output_file = open(java_utils_log_path)
-    else:
-        pattern = RULEKEY_LINE
-        build_output_file = tmpFile
-
-    rule_debug_map = {}
-    for line in build_output_file:
-        match = pattern.match(line)
-        if match:
-            rule_debug_map[match.group('rule_key')] = match.group(
-                'rule_key_debug')
+        finish = datetime.now()
+        if returncode:
+            output_file.seek(max(
+                0,
+                os.fstat(output_file.fileno()).st_size -
+                BUILD_OUTPUT_TAIL_BYTES))
+            log('Buck build failed: %s' % output_file.read().decode(
+                'utf-8', 'replace'))
+            raise subprocess.CalledProcessError(returncode, command)
+
+        java_utils_log_path = get_java_utils_log_path(cwd, perftest_side)
+        if java_utils_log_path:
+            pattern = BUCK_LOG_RULEKEY_LINE
+            rule_key_log = open(java_utils_log_path, 'rb')
+        else:
+            pattern = RULEKEY_LINE
+            rule_key_log = output_file
+
+        rule_debug_map = {}
+        # Rule keys are logged repeatedly, keep the first debug string for
+        # each.
+        set_rule_key_debug = rule_debug_map.setdefault
+        with rule_key_log:
+            for rule_key, rule_key_debug in find_all_in_file(
+                    pattern, rule_key_log):
+                set_rule_key_debug(rule_key, rule_key_debug)
 
     logfile_path = os.path.join(
         cwd,
         'buck-out', 'bin', 'build.log')
-    cache_results = defaultdict(list)
+    cache_results = defaultdict(new_cache_results)
     rule_key_map = {}
-    with open(logfile_path, 'r') as logfile:
-        for line in logfile.readlines():
-            line = line.strip()
-            match = BUILD_RESULT_LOG_LINE.search(line)
-            if match:
-                rule_name = match.group('rule_name')
-                rule_key = match.group('rule_key')
-                if not rule_key in rule_debug_map:
-                    raise Exception('''ERROR: build.log contains an entry
-                        which was not found in buck build -v 5 output.
-                        Rule: {0}, rule key: {1}'''.format(rule_name, rule_key))
-                cache_results[match.group('cache_result')].append({
-                    'rule_name': rule_name,
-                    'rule_key': rule_key,
-                    'rule_key_debug': rule_debug_map[rule_key]
-                })
-                rule_key_map[match.group('rule_name')] = (rule_key, rule_debug_map[rule_key])
+    with open(logfile_path, 'rb') as logfile:
+        for rule_name, _, cache_result, _, rule_key in find_all_in_file(
+                BUILD_RESULT_LOG_LINE, logfile):
+            try:
+                rule_key_debug = rule_debug_map[rule_key]
+            except KeyError:
+                raise Exception('''ERROR: build.log contains an entry
+                    which was not found in buck build -v 5 output.
+                    Rule: {0}, rule key: {1}'''.format(
+                        rule_name, rule_key)) from None
+            rules = cache_results[sys.intern(cache_result)]
+            rules.rule_names.append(rule_name)
+            rules.rule_keys.append(rule_key)
+            rules.rule_key_debugs.append(rule_key_debug)
+            rule_key_map[rule_name] = (rule_key, rule_key_debug)
 
     result = BuildResult(finish - start, cache_results, rule_key_map)
     cache_counts = {}
-    for key, value in result.cache_results.iteritems():
-        cache_counts[key] = len(value)
+    for key, value in result.cache_results.items():
+        cache_counts[key] = len(value.rule_names)
     log('Test Build Finished! Elapsed Seconds: %d, Cache Counts: %s' % (
-        timedelta_total_seconds(result.time_delta), repr(cache_counts)))
+        result.time_delta.total_seconds(), repr(cache_counts)))
     return result
 
 
+BUCKCONFIG_TEMPLATE = '''[cache]
+dir = buck-cache-{perftest_side}
+dir_mode = {cache_mode}
+'''
+
+
+DIR_CACHE_ONLY_BUCKCONFIG_TEMPLATE = '''[cache]
+mode = dir
+dir = buck-cache-{perftest_side}
+dir_mode = {cache_mode}
+'''
+
+
 def set_perftest_side(
         args,
         cwd,
@@ -262,20 +402,19 @@ def set_perftest_side(
         dir_cache_only=True):
     log('Reconfiguring to test %s version of buck.' % perftest_side)
     buckconfig_path = os.path.join(cwd, '.buckconfig.local')
-    with open(buckconfig_path, 'w') as buckconfig:
-        buckconfig.write('''[cache]
-    %s
-    dir = buck-cache-%s
-    dir_mode = %s
-  ''' % ('mode = dir' if dir_cache_only else '', perftest_side, cache_mode))
-        buckconfig.truncate()
+    if dir_cache_only:
+        buckconfig_template = DIR_CACHE_ONLY_BUCKCONFIG_TEMPLATE
+    else:
+        buckconfig_template = BUCKCONFIG_TEMPLATE
+    write_file_if_changed(buckconfig_path, buckconfig_template.format(
+        perftest_side=perftest_side,
+        cache_mode=cache_mode))
     buckversion_path = os.path.join(cwd, '.buckversion')
-    with open(buckversion_path, 'w') as buckversion:
-        if perftest_side == 'old':
-            buckversion.write(args.old_buck_revision + os.linesep)
-        else:
-            buckversion.write(args.new_buck_revision + os.linesep)
-        buckversion.truncate()
+    if perftest_side == 'old':
+        buck_revision = args.old_buck_revision
+    else:
+        buck_revision = args.new_buck_revision
+    write_file_if_changed(buckversion_path, buck_revision + os.linesep)
 
 
 def build_all_targets(
@@ -292,20 +431,35 @@ def build_all_targets(
         perftest_side,
         cache_mode,
         dir_cache_only=dir_cache_only)
-    targets = []
-    for target_str in args.targets_to_build:
-        targets.extend(target_str.split(','))
     if run_clean:
         buck_clean(args, cwd)
     #TODO(rowillia): Do smart things with the results here.
     return buck_build_target(
         args,
         cwd,
-        targets,
+        args.targets,
         perftest_side,
         log_as_perftest=log_as_perftest)
 
 
+def warm_up_cache(args, cwd, perftest_side):
+    # build with different variations to warm up cache and work around
+    # cache weirdness
+    build_all_targets(
+        args,
+        cwd,
+        perftest_side,
+        'readwrite',
+        dir_cache_only=False,
+        log_as_perftest=False)
+    return build_all_targets(
+        args,
+        cwd,
+        perftest_side,
+        'readwrite',
+        log_as_perftest=False)
+
+
 def run_tests_for_diff(args, revisions_to_test, test_index, last_result):
     log('=== Running tests at revision %s ===' % revisions_to_test[test_index])
     new_directory_name = (os.path.basename(args.repo_under_test) +
@@ -316,6 +470,10 @@ def run_tests_for_diff(args, revisions_to_test, test_index, last_result):
                        new_directory_name)
     cwd = os.path.join(cwd_root, args.project_under_test)
 
+    # Stop buckd first so it doesn't keep watching the old path.
+    buck_kill(
+        args,
+        os.path.join(args.repo_under_test, args.project_under_test))
     log('Renaming %s to %s' % (args.repo_under_test, cwd_root))
     os.rename(args.repo_under_test, cwd_root)
 
@@ -333,8 +491,7 @@ def run_tests_for_diff(args, revisions_to_test, test_index, last_result):
                 'This suggests one of the rule keys contains an '
                 'absolute path.' % (
                     revisions_to_test[test_index - 1]))
-            for rule in result.cache_results['MISS']:
-                rule_name = rule['rule_name']
+            for rule_name in result.cache_results['MISS'].rule_names:
                 key, key_debug = result.rule_key_map[rule_name]
                 old_key, old_key_debug = last_result.rule_key_map[rule_name]
                 log('Rule %s missed.' % rule_name)
@@ -344,7 +501,7 @@ def run_tests_for_diff(args, revisions_to_test, test_index, last_result):
 
         checkout(revisions_to_test[test_index], cwd_root)
 
-        for attempt in xrange(args.iterations_per_diff):
+        for attempt in range(args.iterations_per_diff):
             cache_mode = 'readonly'
             if attempt == args.iterations_per_diff - 1:
                 cache_mode = 'readwrite'
@@ -367,7 +524,10 @@ def run_tests_for_diff(args, revisions_to_test, test_index, last_result):
                 'buck version did not hit all of it\'s keys.\nMissed '
                 'Rules: %s' % (
                     revisions_to_test[test_index - 1],
-                    repr(result.cache_results)))
+                    repr(dict(
+                        (cache_result, rules.rule_names)
+                        for cache_result, rules
+                        in result.cache_results.items()))))
 
     finally:
         log('Renaming %s to %s' % (cwd_root, args.repo_under_test))
@@ -378,6 +538,14 @@ def run_tests_for_diff(args, revisions_to_test, test_index, last_result):
 
 def main():
     args = createArgParser().parse_args()
+    # Flush each log line as it is written so progress can be followed.
+    sys.stdout.reconfigure(line_buffering=True)
+    # Each --targets_to_build may list several comma separated targets.
+    args.targets = [
+        target
+        for target_str in args.targets_to_build
+        for target in target_str.split(',')
+    ]
     log('Running Performance Test!')
     clean(args.repo_under_test)
     revisions_to_test = get_revisions(args)
@@ -388,36 +556,10 @@ def main():
     log('=== Warming up cache ===')
     checkout(revisions_to_test[0], args.repo_under_test)
     cwd = os.path.join(args.repo_under_test, args.project_under_test)
-    # build with different variations to warm up cache and work around
-    # cache weirdness
-    build_all_targets(
-        args,
-        cwd,
-        'old',
-        'readwrite',
-        dir_cache_only=False,
-        log_as_perftest=False)
-    build_all_targets(
-        args,
-        cwd,
-        'old',
-        'readwrite',
-        log_as_perftest=False)
-    build_all_targets(
-        args,
-        cwd,
-        'new',
-        'readwrite',
-        dir_cache_only=False,
-        log_as_perftest=False)
-    results_for_new = build_all_targets(
-        args,
-        cwd,
-        'new',
-        'readwrite',
-        log_as_perftest=False)
+    warm_up_cache(args, cwd, 'old')
+    results_for_new = warm_up_cache(args, cwd, 'new')
     log('=== Cache Warm!  Running tests ===')
-    for i in xrange(1, args.revisions_to_go_back):
+    for i in range(1, args.revisions_to_go_back):
         results_for_new = run_tests_for_diff(
             args,
             revisions_to_test,